@@ -1,38 +1,88 @@
 """Main script for processing files for Paperless and bookkeeping via email."""
 
+import atexit
+import base64
+import contextlib
+import email.policy
+import errno
 import logging
+import mimetypes
+import mmap
+import os
+import queue
+import shutil
 import smtplib
 import ssl
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from email.message import EmailMessage
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from typing import Protocol
+from typing import BinaryIO, Protocol, Self, TypeIs
 
 import requests
 import urllib3
 from environs import Env, validate
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
 
 # Load environment variables
 env = Env()
 env.read_env()
+# Validators for environment variables holding an email address, built once and shared
+EMAIL_VALIDATORS = [validate.Length(min=4), validate.Email()]
 
 # Logging setup: log to file and console, rotate at 10MB
 LOG_FILENAME = Path(__file__).parent / "paperless_email_processor.log"
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-MAIN_PATH: Path
-SMTP_VARS: SmtpVars
-ERROR_EMAIL: str
-FROM_EMAIL: str
+# Default maximum number of files processed concurrently within a folder
+MAX_WORKERS = 8
+# Read size for encoding attachments, a multiple of 57 bytes so each chunk encodes to whole base64 lines
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+# Loading the CA bundle is costly, so all SMTP connections share one context
+SSL_CONTEXT = ssl.create_default_context()
+# Maximum number of response body bytes included in log messages
+LOG_BODY_LIMIT = 512
+# In watch mode, seconds to let a burst of file events settle before processing
+EVENT_SETTLE_DELAY = 2
+# In watch mode, seconds between full sweeps of all folders, to catch missed events
+SWEEP_INTERVAL = 3600
+# Maximum total size of the files sent in one batch email; base64 grows them by a third,
+# which keeps the message under the common 25 MB SMTP limit
+BATCH_SIZE_LIMIT = 15 * 1024 * 1024
+# Seconds a blocking SMTP operation may take, so a silently dropped connection does not hang a send
+SMTP_TIMEOUT = 60
+# The folders processed under PROCESS_FOLDER and the processors, by name, each folder's files are given to
+FOLDERS = {
+    "to_paperless": ["paperless"],
+    "to_bookkeeping": ["bookkeeping"],
+    "to_bookkeeping_paperless": ["paperless", "bookkeeping"],
+    "to_paperless_bookkeeper": ["paperless", "bookkeeper"],
+    "to_bookkeeper": ["bookkeeper"],
+}
 
 if not logger.hasHandlers():
-    file_handler = RotatingFileHandler(LOG_FILENAME, maxBytes=10 * 1024 * 1024, backupCount=2, encoding="utf-8")
+    # delay=True: the log file is only opened, by the listener thread, when the first record is written
+    file_handler = RotatingFileHandler(
+        LOG_FILENAME, maxBytes=10 * 1024 * 1024, backupCount=2, encoding="utf-8", delay=True
+    )
     file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
-    logger.addHandler(file_handler)
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
-    logger.addHandler(console_handler)
+    # The handlers write from a background thread, logging calls only put the record on a queue
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
 
 @dataclass
@@ -59,181 +109,616 @@ class EmailVars:
     """Email configuration variables."""
 
     to: str
+    batch: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Configuration shared by the processors and the folder processing."""
+
+    main_path: Path
+    from_email: str
+    error_email: str
+    smtp: SmtpVars
 
 
 class FileProcessor(Protocol):
-    """Protocol for file processors."""
+    """Protocol for file processors.
+
+    Processors with batch set are batch processors (see BatchFileProcessor) and get all files at once.
+    """
+
+    batch: bool
+
+    def process(self, filepath: Path, data: mmap.mmap | None = None) -> bool:
+        """Process the file and return True if successful, False otherwise.
+
+        When data is given it is a read-only memory map of the file, shared with the other processors.
+        """
+
+
+class BatchFileProcessor(FileProcessor, Protocol):
+    """Protocol for file processors that can process all files of a folder at once."""
+
+    def process_batch(self, filepaths: list[Path]) -> bool:
+        """Process the files together and return True if successful, False otherwise."""
+
+
+class MappedReader:
+    """File-like reader over a memory map, starting at the beginning of the mapping."""
 
-    def process(self, filepath: Path) -> bool:
-        """Process the file and return True if successful, False otherwise."""
+    def __init__(self, data: mmap.mmap) -> None:
+        """Initialize with the memory map and rewind it."""
+        self.data = data
+        data.seek(0)
+
+    @property
+    def len(self) -> int:
+        """Return the number of bytes left to read, as MultipartEncoder expects from a reader."""
+        return len(self.data) - self.data.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes, or the rest of the mapping when size is negative."""
+        return self.data.read(size)
+
+
+@contextlib.contextmanager
+def map_file(filepath: Path) -> Iterator[mmap.mmap | None]:
+    """Memory-map the file read-only, yielding None for an empty file as it cannot be mapped."""
+    with filepath.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield None
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
 
 
 class PaperlessAPIProcessor:
     """Processor for uploading files to the Paperless API."""
 
-    def __init__(self, vars: PaperlessVars) -> None:
-        """Initialize with PaperlessVars."""
+    # Paperless takes one document per upload
+    batch = False
+
+    def __init__(self, vars: PaperlessVars, max_connections: int = MAX_WORKERS) -> None:
+        """Initialize with PaperlessVars and the number of connections to keep alive for concurrent uploads."""
         self.vars = vars
+        self.url = f"{vars.api_url.rstrip('/')}{vars.api_path}"
+        # A single session keeps connections alive between uploads
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Token {vars.api_token}"})
+        # A fixed multipart boundary lets the upload headers be built once
+        self.boundary = uuid.uuid4().hex
+        self.upload_headers = {"Content-Type": f"multipart/form-data; boundary={self.boundary}"}
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max_connections,
+            # Only failed connects are retried: a POST is never retried on its status by default, and
+            # retrying after the request was sent would resend an already consumed MultipartEncoder
+            max_retries=Retry(total=3, read=False, backoff_factor=0.3),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self) -> Self:
+        """Enter the context, returning the processor."""
+        return self
 
-    def process(self, filepath: Path) -> bool:
+    def __exit__(self, *exc_info: object) -> None:
+        """Close the session when leaving the context."""
+        self.close()
+
+    def close(self) -> None:
+        """Close the HTTP session and its pooled connections."""
+        self.session.close()
+
+    def process(self, filepath: Path, data: mmap.mmap | None = None) -> bool:
         """Process the file and upload it to the Paperless API."""
-        url = f"{self.vars.api_url.rstrip('/')}{self.vars.api_path}"
-        headers = {"Authorization": f"Token {self.vars.api_token}"}
         try:
-            with filepath.open("rb") as f:
-                response = requests.post(url, headers=headers, files={"document": f}, timeout=10)
+            status, body = self._upload(filepath, data)
         except requests.ConnectionError as e:
-            logger.error(f"Failed to connect to Paperless API: {e}")
+            logger.error("Failed to connect to Paperless API: %s", e)
             return False
         except urllib3.exceptions.MaxRetryError as e:
-            logger.error(f"Max retries exceeded while connecting to Paperless API: {e}")
+            logger.error("Max retries exceeded while connecting to Paperless API: %s", e)
             return False
         except urllib3.exceptions.NameResolutionError as e:
-            logger.error(f"Name resolution error while connecting to Paperless API: {e}")
+            logger.error("Name resolution error while connecting to Paperless API: %s", e)
             return False
-        logger.debug(f"Response from Paperless: {response.status_code} {response.text}")
-        if response.status_code == 200:
-            logger.info(f"Uploaded to Paperless: {filepath}")
+        except OSError as e:
+            logger.error("Failed to upload %s to Paperless: %s", filepath, e)
+            return False
+        # Decoding the body is only worth it when the record will be emitted
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response from Paperless: %s %s", status, body_snippet(body))
+        if status == 200:
+            logger.info("Uploaded to Paperless: %s", filepath)
             return True
         else:
-            logger.error(f"Failed to upload {filepath} to Paperless: {response.status_code} {response.text}")
+            logger.error("Failed to upload %s to Paperless: %s %s", filepath, status, body_snippet(body))
             return False
 
+    def _upload(self, filepath: Path, data: mmap.mmap | None) -> tuple[int, bytes]:
+        """Upload the file, from its shared memory map when given, returning the response status and body."""
+        content_type = mimetypes.guess_type(filepath.name)[0] or "application/octet-stream"
+        if data is not None:
+            return self._post(MappedReader(data), filepath.name, content_type)
+        with filepath.open("rb") as f:
+            return self._post(f, filepath.name, content_type)
+
+    def _post(self, f: BinaryIO | MappedReader, filename: str, content_type: str) -> tuple[int, bytes]:
+        """Upload the file through the session, returning the response status and body."""
+        # The encoder streams the file into the request instead of building the whole body in memory
+        encoder = MultipartEncoder(fields={"document": (filename, f, content_type)}, boundary=self.boundary)
+        response = self.session.post(self.url, data=encoder, headers=self.upload_headers, timeout=10)
+        return response.status_code, response.content
+
+
+def body_snippet(body: bytes) -> str:
+    """Return the start of a response body for logging, without decoding the whole body."""
+    return body[:LOG_BODY_LIMIT].decode("utf-8", errors="replace")
+
 
 class EmailProcessor:
     """Processor for sending files via email to bookkeeping."""
 
-    def __init__(self, vars: EmailVars) -> None:
-        """Initialize with EmailVars."""
+    def __init__(self, vars: EmailVars, config: Config) -> None:
+        """Initialize with EmailVars and the shared Config."""
         self.vars = vars
-
-    def process(self, filepath: Path) -> bool:
+        self.config = config
+        self.batch = vars.batch
+        self._server: smtplib.SMTP_SSL | None = None
+        # Address headers are costly to parse, so they are parsed once and reused for every message
+        template = EmailMessage()
+        template["From"] = config.from_email
+        template["To"] = vars.to
+        self._headers = template.items()
+        # smtplib connections are not thread-safe, so sends are serialized per processor
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> Self:
+        """Enter the context, returning the processor."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Close the SMTP connection when leaving the context."""
+        self.close()
+
+    def close(self) -> None:
+        """Close the SMTP connection, if one is open."""
+        with self._lock:
+            if self._server is not None:
+                with contextlib.suppress(smtplib.SMTPException, OSError):
+                    self._server.quit()
+                self._server = None
+
+    def _send(self, msg: EmailMessage) -> None:
+        """Send the message over the shared connection, reconnecting once if the server dropped it."""
+        # Serialize once, outside the lock, so a retry does not serialize the message again
+        payload = msg.as_bytes(policy=email.policy.SMTP)
+        with self._lock:
+            if self._server is None:
+                self._server = smtp_connect(self.config.smtp)
+            try:
+                self._server.sendmail(msg["From"], [msg["To"]], payload)
+            except smtplib.SMTPServerDisconnected:
+                logger.info("SMTP connection was closed by the server, reconnecting.")
+                self._server = smtp_connect(self.config.smtp)
+                self._server.sendmail(msg["From"], [msg["To"]], payload)
+
+    def _new_message(self, subject: str) -> EmailMessage:
+        """Create a message with the given subject and the processor's From and To headers."""
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        for name, value in self._headers:
+            msg[name] = value
+        return msg
+
+    def process(self, filepath: Path, data: mmap.mmap | None = None) -> bool:
         """Process the file and send it via email."""
-        msg = new_email_message(
-            subject=filepath.name,
-            smtp_to=self.vars.to,
-        )
+        msg = self._new_message(subject=filepath.name)
         msg.set_content(f"Hi,\n\nPlease find attached the file: {filepath.name}.\n\nBest regards.")
-        with filepath.open("rb") as f:
-            msg.add_attachment(
-                f.read(),
-                maintype="application",
-                subtype="octet-stream",
-                filename=filepath.name,
-            )
+        add_file_attachment(msg, filepath, data)
+        try:
+            self._send(msg)
+        except Exception as e:
+            logger.error("Failed to send %s via email: %s", filepath, e)
+            return False
+        else:
+            logger.info("Sent successfully via email: %s", filepath)
+            return True
+
+    def process_batch(self, filepaths: list[Path]) -> bool:
+        """Send the files as attachments of a single email."""
+        msg = self._new_message(subject=filepaths[0].name if len(filepaths) == 1 else f"{len(filepaths)} files")
+        listing = "\n".join(f"- {filepath.name}" for filepath in filepaths)
+        msg.set_content(f"Hi,\n\nPlease find attached the files:\n{listing}\n\nBest regards.")
+        for filepath in filepaths:
+            add_file_attachment(msg, filepath)
         try:
-            send_email(msg=msg)
+            self._send(msg)
         except Exception as e:
-            logger.error(f"Failed to send {filepath} via email: {e}")
+            logger.error("Failed to send %d files via email: %s", len(filepaths), e)
             return False
         else:
-            logger.info(f"Sent successfully via email: {filepath}")
+            logger.info("Sent %d files successfully via email from %s", len(filepaths), filepaths[0].parent)
             return True
 
 
-def move_to_done(filepath: Path) -> None:
-    """Move processed file to the done directory."""
-    # Get the parent directory name (e.g., to_paperless, to_bookkeeping, to_all)
-    parent = filepath.parent.name
-    done_dir = MAIN_PATH / "done" / parent
-    done_dir.mkdir(parents=True, exist_ok=True)
+@contextlib.contextmanager
+def open_dir(path: Path) -> Iterator[int | None]:
+    """Open a directory for relative renames, yielding None where the platform does not support them."""
+    # os.replace shares its implementation with os.rename, only the latter is listed in supports_dir_fd
+    if os.rename not in os.supports_dir_fd:
+        yield None
+        return
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def move_to_done(filepath: Path, done_dir: Path, src_dir_fd: int | None = None, dst_dir_fd: int | None = None) -> None:
+    """Move processed file to the done directory.
+
+    The done directory must already exist. A rename is tried first; when the done directory is on
+    another filesystem the file is copied (with sendfile where available) and the original removed.
+    With both directories open (see open_dir) the rename is relative to them, so the kernel does not
+    resolve the full paths again for every file.
+    """
     target = done_dir / filepath.name
-    filepath.rename(target)
-    logger.info(f"Moved {filepath} to {target}")
+    try:
+        if src_dir_fd is not None and dst_dir_fd is not None:
+            os.replace(filepath.name, filepath.name, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+        else:
+            os.replace(filepath, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(filepath, target)
+        os.unlink(filepath)
+    logger.info("Moved %s to %s", filepath, target)
+
+
+def move_all_to_done(files: list[Path], folder: Path, done_dir: Path) -> list[tuple[str, str]]:
+    """Move the processed files of the folder to the done directory, creating it when needed.
+
+    A file that cannot be moved is logged and skipped, so the other files are still moved.
+    Returns the (filename, "move_to_done") pairs of the files that were not moved.
+    """
+    failures = []
+    done_dir.mkdir(parents=True, exist_ok=True)
+    with open_dir(folder) as src_dir_fd, open_dir(done_dir) as dst_dir_fd:
+        for file in files:
+            try:
+                move_to_done(file, done_dir, src_dir_fd, dst_dir_fd)
+            except OSError as e:
+                logger.error("Failed to move %s to %s: %s", file, done_dir, e)
+                failures.append((file.name, "move_to_done"))
+    return failures
+
+
+def process_file(file: Path, processors: list[FileProcessor]) -> list[tuple[str, str]]:
+    """Process a single file with the provided processors.
 
+    A processor raising counts as a failure, so the other files of the folder are still moved or reported.
+    Returns the (filename, processor name) pairs of the processors that failed.
+    """
+    failures = []
+    try:
+        # With several processors the file is mapped once and shared, instead of each processor reading it
+        with map_file(file) if len(processors) > 1 else contextlib.nullcontext() as data:
+            for processor in processors:
+                try:
+                    succeeded = processor.process(file, data)
+                except Exception:
+                    logger.exception("Failed to process %s with %s", file, type(processor).__name__)
+                    succeeded = False
+                if not succeeded:
+                    failures.append((file.name, type(processor).__name__))
+    except (OSError, ValueError) as e:
+        logger.error("Failed to read %s: %s", file, e)
+        return [(file.name, type(processor).__name__) for processor in processors]
+    return failures
+
+
+def batches_by_size(files: list[Path], limit: int) -> Iterator[list[Path]]:
+    """Split the files into consecutive batches of at most limit bytes, a larger file gets a batch of its own."""
+    batch: list[Path] = []
+    batch_size = 0
+    for file in files:
+        try:
+            size = file.stat().st_size
+        except OSError:
+            # The processor reports the file as failed when it cannot read it
+            size = 0
+        if batch and batch_size + size > limit:
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(file)
+        batch_size += size
+    if batch:
+        yield batch
 
-def process_folder(folder: Path, processors: list[FileProcessor]) -> None:
+
+def is_batch_processor(processor: FileProcessor) -> TypeIs[BatchFileProcessor]:
+    """Return whether the processor has batching enabled."""
+    return processor.batch
+
+
+def process_batch(files: list[Path], processor: BatchFileProcessor) -> list[tuple[str, str]]:
+    """Process the files with a batch processor, returning the (filename, processor name) failures.
+
+    A failed or raising batch counts as a failure for each of its files.
+    """
+    try:
+        succeeded = processor.process_batch(files)
+    except Exception:
+        logger.exception("Failed to process %d files with %s", len(files), type(processor).__name__)
+        succeeded = False
+    return [] if succeeded else [(file.name, type(processor).__name__) for file in files]
+
+
+def process_folder(
+    folder: Path, processors: list[FileProcessor], config: Config, max_workers: int = MAX_WORKERS
+) -> None:
     """Process files in the given folder with the provided processors.
 
-    Files starting with a dot are ignored.
+    Files starting with a dot are ignored. The work is dominated by network I/O,
+    so up to max_workers files are processed concurrently in a thread pool. Batch processors
+    with batching enabled get the files in batches of up to BATCH_SIZE_LIMIT bytes instead.
+    Files for which all processors succeed are then moved to the done directory in one batch,
+    and failures are reported in a single error email per folder.
+    """
+    # DirEntry.is_file() uses the file type from the directory listing, avoiding a stat per entry
+    try:
+        with os.scandir(folder) as entries:
+            files = [Path(entry.path) for entry in entries if not entry.name.startswith(".") and entry.is_file()]
+    except FileNotFoundError:
+        # Only create the folder when it is missing, a new folder has nothing to process yet
+        folder.mkdir()
+        return
+    if not files:
+        return
+
+    batch_processors = [p for p in processors if is_batch_processor(p)]
+    file_processors = [p for p in processors if not p.batch]
+    failures: list[tuple[str, str]] = []
+    if file_processors:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+            futures = [executor.submit(process_file, file, file_processors) for file in files]
+            for future in futures:
+                failures.extend(future.result())
+    for processor in batch_processors:
+        for batch in batches_by_size(files, BATCH_SIZE_LIMIT):
+            failures.extend(process_batch(batch, processor))
+
+    failed = {filename for filename, _ in failures}
+    if succeeded := [file for file in files if file.name not in failed]:
+        # Processed files are moved to a done directory named after their folder (e.g., done/to_paperless)
+        failures.extend(move_all_to_done(succeeded, folder, config.main_path / "done" / folder.name))
+        failed = {filename for filename, _ in failures}
+
+    if failures:
+        error_email(
+            subject=f"File Processing Error: {len(failed)} of {len(files)} files failed",
+            failures=failures,
+            config=config,
+        )
+
+
+def process_folders(folders: dict[Path, list[FileProcessor]], config: Config, max_workers: int = MAX_WORKERS) -> None:
+    """Process the given folders, each with its own processors.
+
+    The folders are independent, so they are processed concurrently.
     """
-    folder.mkdir(exist_ok=True)
-    for file in list(folder.iterdir()):
-        if not file.is_file() or file.name.startswith("."):
-            continue
-
-        # Track if any processor succeeded
-        processed = 0
-        for processor in processors:
-            # Only move to done if all processors succeed
-            result = processor.process(file)
-            processed += result
-            if not result:
-                error_email(subject="File Processing Error", filename=file.name)
-
-        if processed == len(processors):
-            move_to_done(file)
-
-
-def error_email(subject: str, filename: str) -> None:
-    """Send an error email notification."""
-    msg = new_email_message(subject, smtp_to=ERROR_EMAIL)
-    body = f"An error occurred while processing file: {filename!r}\nCheck the logs for more details."
+    with ThreadPoolExecutor(max_workers=len(folders)) as executor:
+        futures = [
+            executor.submit(process_folder, folder, processors, config, max_workers)
+            for folder, processors in folders.items()
+        ]
+        for future in futures:
+            future.result()
+
+
+class FolderEventHandler(FileSystemEventHandler):
+    """Filesystem event handler queueing the folder of each file written to or moved into it.
+
+    A created file is only queued once its writer closes it, so a slow scanner or network copy is
+    not processed half-written. Where the observer reports no close events, the sweep picks files up.
+    """
+
+    def __init__(self, pending: queue.SimpleQueue[Path]) -> None:
+        """Initialize with the queue receiving the folders to process."""
+        self.pending = pending
+
+    def on_closed(self, event: FileSystemEvent) -> None:
+        """Queue the folder of a file closed after writing."""
+        if not event.is_directory:
+            self.pending.put(Path(os.fsdecode(event.src_path)).parent)
+
+    def on_moved(self, event: FileSystemEvent) -> None:
+        """Queue the folder a file was moved into."""
+        if not event.is_directory:
+            self.pending.put(Path(os.fsdecode(event.dest_path)).parent)
+
+
+def watch(folders: dict[Path, list[FileProcessor]], config: Config, max_workers: int = MAX_WORKERS) -> None:
+    """Process folders whenever files arrive in them, until interrupted.
+
+    Filesystem events (inotify on Linux) wake the loop instead of polling. A full sweep runs
+    right away, for the files already there, and then every SWEEP_INTERVAL seconds, whatever the
+    activity, to catch events that were missed.
+    """
+    pending: queue.SimpleQueue[Path] = queue.SimpleQueue()
+    handler = FolderEventHandler(pending)
+    observer = Observer()
+    for folder in folders:
+        observer.schedule(handler, str(folder))
+    observer.start()
+    logger.info("Watching %d directories for new files...", len(folders))
+    next_sweep = time.monotonic()
+    try:
+        while True:
+            changed = wait_for_changes(pending, timeout=max(0.0, next_sweep - time.monotonic()))
+            if time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + SWEEP_INTERVAL
+                watch_pass(folders, config, max_workers)
+            elif changed_folders := {folder: folders[folder] for folder in changed if folder in folders}:
+                watch_pass(changed_folders, config, max_workers)
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def wait_for_changes(pending: queue.SimpleQueue[Path], timeout: float) -> set[Path]:
+    """Wait up to timeout seconds for queued folders, returning the folders changed in the burst."""
+    try:
+        changed = {pending.get(timeout=timeout)}
+    except queue.Empty:
+        return set()
+    # Files tend to arrive in bursts, wait for them and process each folder once
+    time.sleep(EVENT_SETTLE_DELAY)
+    while not pending.empty():
+        changed.add(pending.get_nowait())
+    return changed
+
+
+def watch_pass(folders: dict[Path, list[FileProcessor]], config: Config, max_workers: int) -> None:
+    """Process the folders once in watch mode, keeping the watch alive whatever goes wrong.
+
+    SMTP connections are closed afterwards, as they would otherwise sit idle until the next pass.
+    """
+    try:
+        process_folders(folders, config, max_workers)
+    except Exception:
+        logger.exception("Failed to process %d directories, continuing to watch.", len(folders))
+    for processor in {p for processors in folders.values() for p in processors if isinstance(p, EmailProcessor)}:
+        processor.close()
+
+
+def error_email(subject: str, failures: list[tuple[str, str]], config: Config) -> None:
+    """Send an error email notification listing the (filename, processor name) failures."""
+    msg = new_email_message(subject, smtp_from=config.from_email, smtp_to=config.error_email)
+    lines = "\n".join(f"- {filename!r} ({processor})" for filename, processor in failures)
+    body = f"An error occurred while processing the following files:\n{lines}\nCheck the logs for more details."
     msg.set_content(body)
 
     try:
-        send_email(msg=msg)
+        send_email(msg=msg, smtp=config.smtp)
     except Exception as e:
-        logger.error(f"Failed to send error email: {e}")
+        logger.error("Failed to send error email: %s", e)
         raise e
     else:
         logger.info("Sent error email successfully.")
 
 
-def new_email_message(subject: str, smtp_to: str) -> EmailMessage:
+def new_email_message(subject: str, smtp_from: str, smtp_to: str) -> EmailMessage:
     """Define a new email message."""
     msg = EmailMessage()
     msg["Subject"] = subject
-    msg["From"] = FROM_EMAIL
+    msg["From"] = smtp_from
     msg["To"] = smtp_to
     return msg
 
 
-def send_email(msg: EmailMessage) -> None:
-    """Send an email message via SMTP."""
-    with smtplib.SMTP_SSL(SMTP_VARS.smtp_srv, SMTP_VARS.smtp_port, context=ssl.create_default_context()) as server:
+def encode_attachment(f: BinaryIO | MappedReader) -> str:
+    """Base64 encode an open file into MIME body lines, reading it in chunks."""
+    return "".join(
+        base64.encodebytes(chunk).decode("ascii") for chunk in iter(lambda: f.read(ATTACHMENT_CHUNK_SIZE), b"")
+    )
+
+
+def add_file_attachment(msg: EmailMessage, filepath: Path, data: mmap.mmap | None = None) -> None:
+    """Attach a file to the message.
+
+    The attachment is encoded chunk by chunk instead of reading the whole file into memory first,
+    as EmailMessage.add_attachment would. An existing memory map of the file is used when given.
+    """
+    part = EmailMessage(policy=msg.policy)
+    part["Content-Type"] = "application/octet-stream"
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename=filepath.name)
+    if data is not None:
+        part.set_payload(encode_attachment(MappedReader(data)))
+    else:
+        with filepath.open("rb") as f:
+            part.set_payload(encode_attachment(f))
+    if msg.get_content_type() != "multipart/mixed":
+        msg.make_mixed()
+    msg.attach(part)
+
+
+def smtp_connect(smtp: SmtpVars) -> smtplib.SMTP_SSL:
+    """Open an authenticated SMTP connection."""
+    server = smtplib.SMTP_SSL(smtp.smtp_srv, smtp.smtp_port, timeout=SMTP_TIMEOUT, context=SSL_CONTEXT)
+    try:
         server.ehlo()
-        server.login(SMTP_VARS.smtp_usr, SMTP_VARS.smtp_pwd)
-        server.send_message(msg)
+        server.login(smtp.smtp_usr, smtp.smtp_pwd)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def send_email(msg: EmailMessage, smtp: SmtpVars) -> None:
+    """Send an email message via SMTP on a connection opened for this message only."""
+    payload = msg.as_bytes(policy=email.policy.SMTP)
+    with smtp_connect(smtp) as server:
+        server.sendmail(msg["From"], [msg["To"]], payload)
 
 
 def main() -> None:
     """Main entry point for the script."""
     # Reading the vars here to ensure env dependencies are present and loaded
+    smtp_vars = SmtpVars(
+        smtp_srv=env.str("SMTP_SRV"),
+        smtp_usr=env.str("SMTP_USR", validate=EMAIL_VALIDATORS),
+        smtp_pwd=env.str("SMTP_PWD"),
+        smtp_port=env.int("SMTP_PORT", default=465),
+    )
+    config = Config(
+        main_path=Path(env.str("PROCESS_FOLDER", default="process_folder")),
+        # The SMTP user is already read and validated above
+        from_email=smtp_vars.smtp_usr,
+        error_email=env.str("ERROR_EMAIL", validate=EMAIL_VALIDATORS),
+        smtp=smtp_vars,
+    )
     paperless_vars = PaperlessVars(
         api_token=env.str("PAPERLESS_API_TOKEN"),
         api_path=env.str("PAPERLESS_API_PATH"),
         api_url=env.str("PAPERLESS_API_URL"),
     )
     bookkeeping_vars = EmailVars(
-        to=env.str("BOOKKEEPING_EMAIL", validate=[validate.Length(min=4), validate.Email()]),
+        to=env.str("BOOKKEEPING_EMAIL", validate=EMAIL_VALIDATORS),
+        batch=env.bool("BOOKKEEPING_BATCH", default=False),
     )
     bookkeeper_vars = EmailVars(
-        to=env.str("BOOKKEEPER_EMAIL", validate=[validate.Length(min=4), validate.Email()]),
+        to=env.str("BOOKKEEPER_EMAIL", validate=EMAIL_VALIDATORS),
+        batch=env.bool("BOOKKEEPER_BATCH", default=False),
     )
-    paperless_processor = PaperlessAPIProcessor(paperless_vars)
-    bookkeeping_processor = EmailProcessor(bookkeeping_vars)
-    to_person_processor = EmailProcessor(bookkeeper_vars)
+    watch_folders = env.bool("WATCH", default=False)
+    max_workers = env.int("MAX_WORKERS", default=MAX_WORKERS, validate=validate.Range(min=1))
 
     logger.info("Loaded variables, processing directories...")
-    process_folder(MAIN_PATH / "to_paperless", processors=[paperless_processor])
-    process_folder(MAIN_PATH / "to_bookkeeping", processors=[bookkeeping_processor])
-    process_folder(MAIN_PATH / "to_bookkeeping_paperless", processors=[paperless_processor, bookkeeping_processor])
-    process_folder(MAIN_PATH / "to_paperless_bookkeeper", processors=[paperless_processor, to_person_processor])
-    process_folder(MAIN_PATH / "to_bookkeeper", processors=[to_person_processor])
+    # The folders upload to Paperless in parallel, each with up to max_workers files in flight
+    paperless_folders = sum("paperless" in names for names in FOLDERS.values())
+    with (
+        PaperlessAPIProcessor(paperless_vars, max_connections=paperless_folders * max_workers) as paperless_processor,
+        EmailProcessor(bookkeeping_vars, config) as bookkeeping_processor,
+        EmailProcessor(bookkeeper_vars, config) as to_person_processor,
+    ):
+        processors: dict[str, FileProcessor] = {
+            "paperless": paperless_processor,
+            "bookkeeping": bookkeeping_processor,
+            "bookkeeper": to_person_processor,
+        }
+        folders = {config.main_path / folder: [processors[name] for name in names] for folder, names in FOLDERS.items()}
+        if watch_folders:
+            watch(folders, config, max_workers)
+        else:
+            process_folders(folders, config, max_workers)
 
 
 if __name__ == "__main__":
-    # Vars
-    PROCESS_FOLDER = env.str("PROCESS_FOLDER", default="process_folder")
-    MAIN_PATH = Path(PROCESS_FOLDER)
-
-    SMTP_VARS = SmtpVars(
-        smtp_srv=env.str("SMTP_SRV"),
-        smtp_usr=env.str("SMTP_USR", validate=[validate.Length(min=4), validate.Email()]),
-        smtp_pwd=env.str("SMTP_PWD"),
-        smtp_port=env.int("SMTP_PORT", default=465),
-    )
-    ERROR_EMAIL = env.str("ERROR_EMAIL", validate=[validate.Length(min=4), validate.Email()])
-    FROM_EMAIL = env.str("SMTP_USR", validate=[validate.Length(min=4), validate.Email()])
     main()
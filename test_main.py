@@ -1,26 +1,43 @@
+import email
+import email.policy
+import errno
+import mmap
 import os
+import queue
+import shutil
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable, Iterator
+from email.message import EmailMessage, Message
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 
 import pytest
+import responses
+from watchdog.events import DirCreatedEvent, FileClosedEvent, FileCreatedEvent, FileModifiedEvent, FileMovedEvent
 
 import main
 
 
-@pytest.fixture(autouse=True)
-def set_env(tmp_path: Path) -> None:
-    os.environ["PROCESS_FOLDER"] = str(tmp_path / "process_folder")
-    main.MAIN_PATH = Path(os.environ["PROCESS_FOLDER"])
-    main.FROM_EMAIL = "from@example.local"
-    main.ERROR_EMAIL = "some@email.local"
-    main.SMTP_VARS = main.SmtpVars(
-        smtp_port=465,
-        smtp_srv="smtp.example.com",
-        smtp_usr="user@example.com",
-        smtp_pwd="password",
+@pytest.fixture
+def config(tmp_path: Path) -> main.Config:
+    return main.Config(
+        main_path=tmp_path / "process_folder",
+        from_email="from@example.local",
+        error_email="some@email.local",
+        smtp=main.SmtpVars(
+            smtp_port=465,
+            smtp_srv="smtp.example.com",
+            smtp_usr="user@example.com",
+            smtp_pwd="password",
+        ),
     )
 
-@pytest.fixture(autouse=True)
+
+@pytest.fixture(scope="module")
 def paperless_vars() -> main.PaperlessVars:
     return main.PaperlessVars(
         api_token="some_token",
@@ -28,89 +45,656 @@ def paperless_vars() -> main.PaperlessVars:
         api_url="http://localhost:8000",
     )
 
-@pytest.fixture(autouse=True)
+
+@pytest.fixture
+def paperless_api() -> Iterator[responses.RequestsMock]:
+    """Intercept requests to the Paperless API at the transport adapter."""
+    with responses.RequestsMock() as mock:
+        yield mock
+
+
+@pytest.fixture(scope="module")
 def bookkeeping_vars() -> main.EmailVars:
     return main.EmailVars(to="recipient@example.com")
 
+
+class _Stub:
+    """Processor stand-in that records the files it was given."""
+
+    batch = False
+
+    def __init__(self, rv: bool = True) -> None:
+        self.rv = rv
+        self.calls: list[Path] = []
+
+    def process(self, filepath: Path, data: mmap.mmap | None = None) -> bool:
+        self.calls.append(filepath)
+        return self.rv
+
+
+class _BatchStub(_Stub):
+    """Batch processor stand-in that records the batches it was given."""
+
+    batch = True
+
+    def __init__(self, rv: bool = True) -> None:
+        super().__init__(rv)
+        self.batches: list[list[Path]] = []
+
+    def process_batch(self, filepaths: list[Path]) -> bool:
+        self.batches.append(filepaths)
+        return self.rv
+
+
 # Fixtures for test files and folders
-def setup_test_file(tmp_path, folder_name="to_paperless", filename="test.pdf") -> Path:
-    folder = tmp_path / folder_name
-    folder.mkdir(parents=True, exist_ok=True)
-    file_path = folder / filename
-    file_path.write_bytes(b"dummy content")
-    return file_path
+@pytest.fixture(scope="session")
+def blob_path(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """Dummy file shared by the whole session, hardlinked into place by setup_test_file."""
+    path = tmp_path_factory.mktemp("blob") / "src.pdf"
+    path.write_bytes(b"dummy content")
+    return path
 
 
-def test_move_to_done(tmp_path: Path) -> None:
+@pytest.fixture
+def setup_test_file(blob_path: Path) -> Callable[..., Path]:
+    def setup(tmp_path, folder_name="to_paperless", filename="test.pdf", content: bytes | None = None) -> Path:
+        """Hardlink the shared dummy blob into place, or write `content` to a file of its own."""
+        folder = tmp_path / folder_name
+        folder.mkdir(parents=True, exist_ok=True)
+        file_path = folder / filename
+        if content is not None:
+            file_path.write_bytes(content)
+            return file_path
+        try:
+            os.link(blob_path, file_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(blob_path, file_path)
+        return file_path
+
+    return setup
+
+
+@pytest.mark.parametrize("cross_device", [False, True], ids=["same_device", "cross_device"])
+def test_move_to_done(
+    tmp_path: Path, config: main.Config, cross_device: bool, setup_test_file: Callable[..., Path]
+) -> None:
+    file_path = setup_test_file(tmp_path / "dir1")
+    done_dir = config.main_path / "done" / "to_paperless"
+    done_dir.mkdir(parents=True)
+    # A rename across filesystems fails with EXDEV, which is simulated as tmp_path is on a single one
+    side_effect = OSError(errno.EXDEV, os.strerror(errno.EXDEV)) if cross_device else os.replace
+    with patch("main.os.replace", side_effect=side_effect) as mock_replace:
+        main.move_to_done(file_path, done_dir)
+    mock_replace.assert_called_once()
+    assert (done_dir / "test.pdf").read_bytes() == b"dummy content"
+    assert not file_path.exists()
+
+
+def test_move_to_done_relative_to_open_dirs(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
     file_path = setup_test_file(tmp_path / "dir1")
-    main.move_to_done(file_path)
-    done_file = main.MAIN_PATH / "done" / "to_paperless" / "test.pdf"
-    assert done_file.exists()
+    done_dir = config.main_path / "done" / "to_paperless"
+    done_dir.mkdir(parents=True)
+    with main.open_dir(file_path.parent) as src_dir_fd, main.open_dir(done_dir) as dst_dir_fd:
+        if src_dir_fd is None or dst_dir_fd is None:
+            pytest.skip("renames relative to directory descriptors are not supported")
+        with patch("main.os.replace", wraps=os.replace) as mock_replace:
+            main.move_to_done(file_path, done_dir, src_dir_fd, dst_dir_fd)
+    mock_replace.assert_called_once_with("test.pdf", "test.pdf", src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+    assert (done_dir / "test.pdf").exists()
     assert not file_path.exists()
 
 
-def test_process_folder_calls_processors(tmp_path: Path) -> None:
+def test_process_folder_calls_processors(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
     file_path = setup_test_file(tmp_path)
-    mock_processor = MagicMock()
-    mock_processor.process.return_value = True  # Make processor succeed
+    stub = _Stub(rv=True)
     with patch("main.send_email") as mock_send_email:
-        main.process_folder(file_path.parent, processors=[mock_processor])
-        mock_processor.process.assert_called_with(file_path)
+        main.process_folder(file_path.parent, processors=[stub], config=config)
+        assert stub.calls == [file_path]
         # Since processor succeeded, send_email should not be called
         mock_send_email.assert_not_called()
+    assert (config.main_path / "done" / "to_paperless" / "test.pdf").exists()
+    assert not file_path.exists()
 
 
-def test_process_folder_calls_error_email_on_failure(tmp_path: Path) -> None:
-    file_path = setup_test_file(tmp_path)
-    mock_processor = MagicMock()
-    mock_processor.process.return_value = False  # Make processor fail
+def test_process_folder_skips_directories(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    pdf_path = setup_test_file(tmp_path)
+    # Receipts are often photos, so files are forwarded whatever their extension
+    jpg_path = setup_test_file(tmp_path, filename="receipt.jpg")
+    (pdf_path.parent / "subdir.pdf").mkdir()
+    stub = _Stub()
+    main.process_folder(pdf_path.parent, processors=[stub], config=config)
+    assert sorted(stub.calls) == [jpg_path, pdf_path]
+    assert (pdf_path.parent / "subdir.pdf").is_dir()
+
+
+def test_process_folder_creates_done_dir_once(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(5)]
+    (config.main_path / "done").mkdir(parents=True)
+    with patch("main.Path.mkdir", autospec=True, side_effect=Path.mkdir) as mock_mkdir:
+        main.process_folder(file_paths[0].parent, processors=[_Stub()], config=config)
+    mock_mkdir.assert_called_once_with(config.main_path / "done" / "to_paperless", parents=True, exist_ok=True)
+    for file_path in file_paths:
+        assert not file_path.exists()
+        assert (config.main_path / "done" / "to_paperless" / file_path.name).exists()
+
+
+def test_process_folder_processes_files_concurrently(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(4)]
+    delay = 0.2
+
+    def process(filepath: Path, data: mmap.mmap | None = None) -> bool:
+        time.sleep(delay)
+        return True
+
+    mock_processor = MagicMock(spec=["process", "batch"], batch=False)
+    mock_processor.process.side_effect = process
+    start = time.perf_counter()
+    main.process_folder(file_paths[0].parent, processors=[mock_processor], config=config)
+    assert time.perf_counter() - start < len(file_paths) * delay
+    assert mock_processor.process.call_count == len(file_paths)
+
+
+def test_process_folder_limits_concurrency(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(4)]
+    active = peak = 0
+    lock = threading.Lock()
+
+    def process(filepath: Path, data: mmap.mmap | None = None) -> bool:
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+        return True
+
+    mock_processor = MagicMock(spec=["process", "batch"], batch=False)
+    mock_processor.process.side_effect = process
+    main.process_folder(file_paths[0].parent, processors=[mock_processor], config=config, max_workers=2)
+    assert peak == 2
+
+
+def test_process_folder_batch_failure_fails_each_file(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(2)]
+    stub = _BatchStub(rv=False)
+    with patch("main.error_email") as mock_error_email:
+        main.process_folder(file_paths[0].parent, processors=[stub], config=config)
+    assert stub.calls == []
+    assert [sorted(batch) for batch in stub.batches] == [file_paths]
+    failures = mock_error_email.call_args.kwargs["failures"]
+    assert sorted(failures) == [(f.name, "_BatchStub") for f in file_paths]
+    assert all(file_path.exists() for file_path in file_paths)
+
+
+def test_process_folder_splits_batches_by_size(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(5)]
+    stub = _BatchStub()
+    # Each dummy file is 13 bytes, so two of them fit in a batch
+    with patch("main.BATCH_SIZE_LIMIT", 30):
+        main.process_folder(file_paths[0].parent, processors=[stub], config=config)
+    assert [len(batch) for batch in stub.batches] == [2, 2, 1]
+    assert sorted(file for batch in stub.batches for file in batch) == file_paths
+    assert all(not file_path.exists() for file_path in file_paths)
+
+
+def test_process_folder_calls_error_email_on_failure(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(3)]
+    stub = _Stub(rv=False)
     with patch("main.send_email") as mock_send_email:
-        main.process_folder(file_path.parent, processors=[mock_processor])
-        mock_processor.process.assert_called_with(file_path)
-        # Since processor failed, send_email should be called for error notification
+        main.process_folder(file_paths[0].parent, processors=[stub], config=config)
+        assert sorted(stub.calls) == file_paths
+        # All failures of the folder are reported in a single error email
         mock_send_email.assert_called_once()
+        msg = mock_send_email.call_args.kwargs["msg"]
+        assert msg["Subject"] == "File Processing Error: 3 of 3 files failed"
+        body = msg.get_content()
+        for file_path in file_paths:
+            assert f"{file_path.name!r} (_Stub)" in body
+    # Failed files stay in place and no done directory is created
+    assert all(file_path.exists() for file_path in file_paths)
+    assert not (config.main_path / "done").exists()
+
+
+def test_process_folder_moves_successes_when_a_processor_raises(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(4)]
+
+    class _Raising(_Stub):
+        def process(self, filepath: Path, data: mmap.mmap | None = None) -> bool:
+            super().process(filepath, data)
+            if filepath.name == "test1.pdf":
+                raise FileNotFoundError(filepath)
+            return True
+
+    with patch("main.error_email") as mock_error_email:
+        main.process_folder(file_paths[0].parent, processors=[_Raising()], config=config)
+    mock_error_email.assert_called_once()
+    assert mock_error_email.call_args.kwargs["failures"] == [("test1.pdf", "_Raising")]
+    assert [file_path.exists() for file_path in file_paths] == [False, True, False, False]
+
 
+def test_process_folder_keeps_moving_when_a_move_fails(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"t{i}.pdf") for i in range(3)]
 
-def test_process_folder_calls_hidden_file(tmp_path: Path) -> None:
+    class _Vanishing(_Stub):
+        def process(self, filepath: Path, data: mmap.mmap | None = None) -> bool:
+            super().process(filepath, data)
+            if filepath.name == "t1.pdf":
+                # The file disappears after a successful upload, before it is moved
+                filepath.unlink()
+            return filepath.name != "t0.pdf"
+
+    with patch("main.error_email") as mock_error_email:
+        main.process_folder(file_paths[0].parent, processors=[_Vanishing()], config=config, max_workers=1)
+    mock_error_email.assert_called_once()
+    assert mock_error_email.call_args.kwargs["subject"] == "File Processing Error: 2 of 3 files failed"
+    assert sorted(mock_error_email.call_args.kwargs["failures"]) == [
+        ("t0.pdf", "_Vanishing"),
+        ("t1.pdf", "move_to_done"),
+    ]
+    assert file_paths[0].exists()
+    assert not file_paths[2].exists()
+    assert (config.main_path / "done" / "to_paperless" / "t2.pdf").exists()
+
+
+def test_process_file_fails_all_processors_on_unreadable_file(tmp_path: Path) -> None:
+    file_path = tmp_path / "vanished.pdf"
+    stubs = [_Stub(), _Stub()]
+    processors: list[main.FileProcessor] = [*stubs]
+    assert main.process_file(file_path, processors) == [("vanished.pdf", "_Stub"), ("vanished.pdf", "_Stub")]
+    assert all(stub.calls == [] for stub in stubs)
+
+
+def test_process_folder_creates_missing_folder(tmp_path: Path, config: main.Config) -> None:
+    folder = tmp_path / "to_paperless"
+    stub = _Stub()
+    main.process_folder(folder, processors=[stub], config=config)
+    assert folder.is_dir()
+    assert stub.calls == []
+    assert not (config.main_path / "done").exists()
+
+
+def test_process_folder_shares_mapping_between_processors(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_path = setup_test_file(tmp_path)
+    seen = []
+
+    def process(filepath: Path, data: mmap.mmap | None = None) -> bool:
+        assert data is not None
+        seen.append((data, data[:]))
+        return True
+
+    processors = [SimpleNamespace(process=process, batch=False), SimpleNamespace(process=process, batch=False)]
+    main.process_folder(file_path.parent, processors=processors, config=config)  # type: ignore[arg-type]
+    (first, first_content), (second, second_content) = seen
+    assert first is second
+    assert first_content == second_content == b"dummy content"
+    assert first.closed
+
+
+def test_process_folder_calls_hidden_file(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
     """No processing and sending email should occur for hidden files."""
     file_path = setup_test_file(tmp_path, filename=".DS_Store")
-    mock_processor = MagicMock()
-    mock_processor.process.return_value = False  # Make processor fail
+    stub = _Stub(rv=False)
     with patch("main.send_email") as mock_send_email:
-        main.process_folder(file_path.parent, processors=[mock_processor])
-        mock_processor.process.assert_not_called()
+        main.process_folder(file_path.parent, processors=[stub], config=config)
+        assert stub.calls == []
         mock_send_email.assert_not_called()
 
-def test_paperless_api_processor_success(tmp_path: Path, paperless_vars: main.PaperlessVars) -> None:
+
+def test_folder_event_handler_queues_folder(tmp_path: Path) -> None:
+    pending: queue.SimpleQueue[Path] = queue.SimpleQueue()
+    handler = main.FolderEventHandler(pending)
+    handler.dispatch(FileClosedEvent(str(tmp_path / "to_paperless" / "new.pdf")))
+    handler.dispatch(FileMovedEvent(str(tmp_path / ".tmp"), str(tmp_path / "to_bookkeeping" / "moved.pdf")))
+    handler.dispatch(DirCreatedEvent(str(tmp_path / "to_paperless" / "subdir")))
+    assert pending.get_nowait() == tmp_path / "to_paperless"
+    assert pending.get_nowait() == tmp_path / "to_bookkeeping"
+    assert pending.empty()
+
+
+def test_folder_event_handler_waits_for_close(tmp_path: Path) -> None:
+    pending: queue.SimpleQueue[Path] = queue.SimpleQueue()
+    handler = main.FolderEventHandler(pending)
+    # A file still being written is created and modified, but not yet closed
+    handler.dispatch(FileCreatedEvent(str(tmp_path / "to_paperless" / "scan.pdf")))
+    handler.dispatch(FileModifiedEvent(str(tmp_path / "to_paperless" / "scan.pdf")))
+    assert pending.empty()
+
+
+def test_watch_keeps_sweeping_after_errors(config: main.Config) -> None:
+    folders: dict[Path, list[main.FileProcessor]] = {config.main_path / "to_paperless": [_Stub()]}
+    # Sweeps are due immediately, the first one fails and the second one ends the watch
+    with (
+        patch("main.SWEEP_INTERVAL", 0),
+        patch("main.Observer"),
+        patch("main.process_folders", side_effect=[main.smtplib.SMTPException("down"), KeyboardInterrupt]) as mock,
+        pytest.raises(KeyboardInterrupt),
+    ):
+        main.watch(folders, config)
+    assert [call.args[0] for call in mock.call_args_list] == [folders, folders]
+
+
+def test_watch_survives_failing_initial_sweep(config: main.Config) -> None:
+    folders: dict[Path, list[main.FileProcessor]] = {config.main_path / "to_paperless": [_Stub()]}
+    with (
+        patch("main.Observer"),
+        patch("main.process_folders", side_effect=main.smtplib.SMTPException("down")) as mock,
+        patch("main.wait_for_changes", side_effect=[set(), KeyboardInterrupt]),
+        pytest.raises(KeyboardInterrupt),
+    ):
+        main.watch(folders, config)
+    mock.assert_called_once_with(folders, config, main.MAX_WORKERS)
+
+
+def test_paperless_api_processor_success(
+    tmp_path: Path,
+    paperless_vars: main.PaperlessVars,
+    paperless_api: responses.RequestsMock,
+    setup_test_file: Callable[..., Path],
+) -> None:
     file_path = setup_test_file(tmp_path)
-    processor = main.PaperlessAPIProcessor(vars=paperless_vars)
-    with patch("main.requests.post") as mock_post:
+    paperless_api.post("http://localhost:8000/api/documents/post_document/", status=200)
+    with main.PaperlessAPIProcessor(vars=paperless_vars) as processor:
+        assert processor.process(file_path) is True
+    request = paperless_api.calls[0].request
+    assert request.headers["Authorization"] == "Token some_token"
+    assert request.headers["Content-Type"] == f"multipart/form-data; boundary={processor.boundary}"
+
+
+def test_paperless_api_processor_failure(
+    tmp_path: Path,
+    paperless_vars: main.PaperlessVars,
+    paperless_api: responses.RequestsMock,
+    setup_test_file: Callable[..., Path],
+) -> None:
+    file_path = setup_test_file(tmp_path)
+    paperless_api.post("http://localhost:8000/api/documents/post_document/", status=500, body=b"error")
+    with main.PaperlessAPIProcessor(vars=paperless_vars) as processor:
+        assert processor.process(file_path) is False
+    assert len(paperless_api.calls) == 1
+
+
+def test_paperless_api_processor_does_not_resend_upload(
+    tmp_path: Path,
+    paperless_vars: main.PaperlessVars,
+    paperless_api: responses.RequestsMock,
+    setup_test_file: Callable[..., Path],
+) -> None:
+    file_path = setup_test_file(tmp_path)
+    paperless_api.post("http://localhost:8000/api/documents/post_document/", status=503)
+    with main.PaperlessAPIProcessor(vars=paperless_vars) as processor:
+        assert processor.process(file_path) is False
+    assert len(paperless_api.calls) == 1
+
+
+def test_paperless_api_processor_pool_size(paperless_vars: main.PaperlessVars) -> None:
+    with main.PaperlessAPIProcessor(vars=paperless_vars, max_connections=24) as processor:
+        adapter = processor.session.get_adapter(paperless_vars.api_url)
+        assert adapter._pool_maxsize == 24  # type: ignore[attr-defined]
+
+
+def test_paperless_api_processor_reuses_headers(
+    tmp_path: Path, paperless_vars: main.PaperlessVars, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(2)]
+    with (
+        main.PaperlessAPIProcessor(vars=paperless_vars) as processor,
+        patch.object(processor.session, "post") as mock_post,
+    ):
         mock_post.return_value.status_code = 200
+        for file_path in file_paths:
+            assert processor.process(file_path) is True
+    # The auth header lives on the session, the upload headers are built once and passed as is
+    assert processor.session.headers["Authorization"] == "Token some_token"
+    assert all(call.kwargs["headers"] is processor.upload_headers for call in mock_post.call_args_list)
+    assert mock_post.call_count == 2
+
+
+def test_body_snippet_truncates_body() -> None:
+    snippet = main.body_snippet(b"\xff" + b"x" * 2000)
+    assert snippet == "\ufffd" + "x" * (main.LOG_BODY_LIMIT - 1)
+
+
+@pytest.fixture
+def paperless_server() -> Iterator[tuple[str, list[tuple[Message, bytes]]]]:
+    """Local HTTP server recording the headers and body of each POST."""
+    received: list[tuple[Message, bytes]] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self) -> None:
+            received.append((self.headers, self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args: object) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", received
+    server.shutdown()
+    server.server_close()
+
+
+def test_paperless_api_processor_upload(
+    tmp_path: Path, paperless_server: tuple[str, list[tuple[Message, bytes]]], setup_test_file: Callable[..., Path]
+) -> None:
+    url, received = paperless_server
+    content = os.urandom(100_000)
+    file_path = setup_test_file(tmp_path, content=content)
+    vars = main.PaperlessVars(api_token="some_token", api_path="/api/documents/post_document/", api_url=url)
+    with main.PaperlessAPIProcessor(vars=vars) as processor:
         assert processor.process(file_path) is True
+    headers, body = received[0]
+    assert headers["Authorization"] == "Token some_token"
+    assert headers["Content-Type"] == f"multipart/form-data; boundary={processor.boundary}"
+    prologue, _, rest = body.partition(b"\r\n\r\n")
+    assert prologue.startswith(f"--{processor.boundary}\r\n".encode())
+    assert b'Content-Disposition: form-data; name="document"; filename="test.pdf"' in prologue
+    assert rest == content + f"\r\n--{processor.boundary}--\r\n".encode()
+
+
+def test_paperless_api_processor_reuses_connection(
+    tmp_path: Path, paperless_server: tuple[str, list[tuple[Message, bytes]]], setup_test_file: Callable[..., Path]
+) -> None:
+    url, received = paperless_server
+    file_paths = [setup_test_file(tmp_path, filename=f"test{i}.pdf") for i in range(3)]
+    vars = main.PaperlessVars(api_token="some_token", api_path="/api/documents/post_document/", api_url=url)
+    with main.PaperlessAPIProcessor(vars=vars) as processor:
+        for file_path in file_paths:
+            assert processor.process(file_path) is True
+        pools = processor.session.get_adapter(url).poolmanager.pools  # type: ignore[attr-defined]
+        assert [pools[key].num_connections for key in pools.keys()] == [1]
+    assert len(received) == 3
+
+
+def test_paperless_api_processor_mapped_upload(
+    tmp_path: Path, paperless_server: tuple[str, list[tuple[Message, bytes]]], setup_test_file: Callable[..., Path]
+) -> None:
+    url, received = paperless_server
+    file_path = setup_test_file(tmp_path)
+    vars = main.PaperlessVars(api_token="some_token", api_path="/api/documents/post_document/", api_url=url)
+    with main.PaperlessAPIProcessor(vars=vars) as processor, main.map_file(file_path) as data:
+        assert processor.process(file_path, data) is True
+    _, body = received[0]
+    assert body.endswith(b"\r\n\r\ndummy content" + f"\r\n--{processor.boundary}--\r\n".encode())
 
 
-def test_paperless_api_processor_failure(tmp_path: Path, paperless_vars: main.PaperlessVars) -> None:
+def test_paperless_api_processor_closes_file_on_error(
+    tmp_path: Path, paperless_vars: main.PaperlessVars, setup_test_file: Callable[..., Path]
+) -> None:
     file_path = setup_test_file(tmp_path)
     processor = main.PaperlessAPIProcessor(vars=paperless_vars)
-    with patch("main.requests.post") as mock_post:
-        mock_post.return_value.status_code = 500
-        mock_post.return_value.text = "error"
+    with patch.object(processor.session, "post", side_effect=main.requests.ConnectionError("down")) as mock_post:
         assert processor.process(file_path) is False
+    _, document, _ = mock_post.call_args.kwargs["data"].fields["document"]
+    assert document.closed
 
 
-def test_bookkeeping_email_processor_success(tmp_path: Path, bookkeeping_vars: main.EmailVars) -> None:
+def test_bookkeeping_email_processor_success(
+    tmp_path: Path, bookkeeping_vars: main.EmailVars, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
     file_path = setup_test_file(tmp_path, folder_name="to_bookkeeping")
-    processor = main.EmailProcessor(vars=bookkeeping_vars)
+    processor = main.EmailProcessor(vars=bookkeeping_vars, config=config)
     with patch("main.smtplib.SMTP_SSL") as mock_smtp:
-        mock_server = MagicMock()
-        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server = mock_smtp.return_value
         assert processor.process(file_path) is True
         mock_server.login.assert_called()
-        mock_server.send_message.assert_called()
+        mock_server.sendmail.assert_called_once()
+        from_addr, to_addrs, payload = mock_server.sendmail.call_args.args
+        assert from_addr == config.from_email
+        assert to_addrs == [bookkeeping_vars.to]
+        assert payload.endswith(b"\r\n")
+        msg = email.message_from_bytes(payload, policy=email.policy.default)
+        assert msg["Subject"] == "test.pdf"
+        assert msg["From"] == config.from_email
+        assert msg["To"] == bookkeeping_vars.to
+
+
+def test_bookkeeping_email_processor_reuses_connection(
+    tmp_path: Path, bookkeeping_vars: main.EmailVars, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, folder_name="to_bookkeeping", filename=f"test{i}.pdf") for i in range(3)]
+    with (
+        patch("main.smtplib.SMTP_SSL") as mock_smtp,
+        main.EmailProcessor(vars=bookkeeping_vars, config=config) as processor,
+    ):
+        for file_path in file_paths:
+            assert processor.process(file_path) is True
+        mock_server = mock_smtp.return_value
+        assert mock_smtp.call_count == 1
+        assert mock_server.login.call_count == 1
+        assert mock_server.sendmail.call_count == 3
+        messages = [email.message_from_bytes(call.args[2]) for call in mock_server.sendmail.call_args_list]
+    mock_server.quit.assert_called_once()
+    # Each message carries its own subject and exactly one set of the shared headers
+    assert [msg["Subject"] for msg in messages] == [file_path.name for file_path in file_paths]
+    assert all(msg.get_all("To") == [bookkeeping_vars.to] for msg in messages)
 
 
-def test_bookkeeping_email_processor_failure(tmp_path: Path, bookkeeping_vars: main.EmailVars) -> None:
+def test_bookkeeping_email_processor_attachment(
+    tmp_path: Path, bookkeeping_vars: main.EmailVars, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_path = setup_test_file(tmp_path, folder_name="to_bookkeeping", content=os.urandom(200_000))
+    processor = main.EmailProcessor(vars=bookkeeping_vars, config=config)
+    with patch("main.smtplib.SMTP_SSL") as mock_smtp:
+        assert processor.process(file_path) is True
+        payload = mock_smtp.return_value.sendmail.call_args.args[2]
+    msg = email.message_from_bytes(payload, policy=email.policy.default)
+    attachment = next(msg.iter_attachments())
+    assert attachment.get_filename() == "test.pdf"
+    assert attachment.get_content() == file_path.read_bytes()
+
+
+def test_add_file_attachment_large_file(tmp_path: Path, setup_test_file: Callable[..., Path]) -> None:
+    size = 10 * 1024 * 1024
+    file_path = setup_test_file(tmp_path, folder_name="to_bookkeeping", content=os.urandom(size))
+    msg = EmailMessage()
+    msg.set_content("Hi")
+    tracemalloc.start()
+    try:
+        main.add_file_attachment(msg, file_path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # The base64 text and the payload string built from it are about 1.35x the file size each,
+    # reading the whole file up front would add another full copy on top
+    assert peak < 3 * size
+
+
+def test_bookkeeping_email_processor_mapped_attachment(
+    tmp_path: Path, bookkeeping_vars: main.EmailVars, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
     file_path = setup_test_file(tmp_path, folder_name="to_bookkeeping")
-    processor = main.EmailProcessor(vars=bookkeeping_vars)
+    processor = main.EmailProcessor(vars=bookkeeping_vars, config=config)
+    with patch("main.smtplib.SMTP_SSL") as mock_smtp, main.map_file(file_path) as data:
+        assert processor.process(file_path, data) is True
+        payload = mock_smtp.return_value.sendmail.call_args.args[2]
+    msg = email.message_from_bytes(payload, policy=email.policy.default)
+    assert next(msg.iter_attachments()).get_content() == b"dummy content"
+
+
+def test_bookkeeping_email_processor_batch(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_paths = [setup_test_file(tmp_path, folder_name="to_bookkeeping", filename=f"test{i}.pdf") for i in range(5)]
+    processor = main.EmailProcessor(vars=main.EmailVars(to="recipient@example.com", batch=True), config=config)
+    with patch("main.smtplib.SMTP_SSL") as mock_smtp:
+        main.process_folder(file_paths[0].parent, processors=[processor], config=config)
+        mock_server = mock_smtp.return_value
+        assert mock_server.sendmail.call_count == 1
+        payload = mock_server.sendmail.call_args.args[2]
+    msg = email.message_from_bytes(payload, policy=email.policy.default)
+    assert msg["Subject"] == "5 files"
+    assert sorted(str(part.get_filename()) for part in msg.iter_attachments()) == [f.name for f in file_paths]
+    assert all(not file_path.exists() for file_path in file_paths)
+
+
+def test_bookkeeping_email_processor_single_file_batch(
+    tmp_path: Path, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_path = setup_test_file(tmp_path, folder_name="to_bookkeeping")
+    processor = main.EmailProcessor(vars=main.EmailVars(to="recipient@example.com", batch=True), config=config)
+    with patch("main.smtplib.SMTP_SSL") as mock_smtp:
+        assert processor.process_batch([file_path]) is True
+        payload = mock_smtp.return_value.sendmail.call_args.args[2]
+    assert email.message_from_bytes(payload, policy=email.policy.default)["Subject"] == "test.pdf"
+
+
+def test_bookkeeping_email_processor_failure(
+    tmp_path: Path, bookkeeping_vars: main.EmailVars, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_path = setup_test_file(tmp_path, folder_name="to_bookkeeping")
+    processor = main.EmailProcessor(vars=bookkeeping_vars, config=config)
     with patch("main.smtplib.SMTP_SSL", side_effect=Exception("fail")):
         assert processor.process(file_path) is False
+
+
+def test_bookkeeping_email_processor_reconnects(
+    tmp_path: Path, bookkeeping_vars: main.EmailVars, config: main.Config, setup_test_file: Callable[..., Path]
+) -> None:
+    file_path = setup_test_file(tmp_path, folder_name="to_bookkeeping")
+    processor = main.EmailProcessor(vars=bookkeeping_vars, config=config)
+    with patch("main.smtplib.SMTP_SSL") as mock_smtp:
+        mock_server = mock_smtp.return_value
+        mock_server.sendmail.side_effect = [main.smtplib.SMTPServerDisconnected("gone"), {}]
+        assert processor.process(file_path) is True
+        assert mock_smtp.call_count == 2
+        assert mock_server.sendmail.call_count == 2
+        # The message is serialized once and the same payload is retransmitted
+        first, second = mock_server.sendmail.call_args_list
+        assert first.args[2] is second.args[2]
+        processor.close()
+        mock_server.quit.assert_called_once()